@@ -1,3 +1,4 @@
+import hashlib
 import multiprocessing
 import random
 from abc import ABCMeta, abstractmethod
@@ -5,12 +6,18 @@ from enum import Enum
 from multiprocessing.pool import Pool
 from pathlib import Path
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from itertools import chain
 from typing import List, Iterable, Callable, Tuple, Any, Optional, TypeVar, Dict
 
+import numpy
+from numpy import ndarray
+
 from speechless.labeled_example import LabeledExample, LabeledSpectrogram, CachedLabeledSpectrogram, \
-    LabeledExampleFromFile, PositionalLabel
-from speechless.tools import group, paginate, mkdir, duplicates, log
+    LabeledExampleFromFile, PositionalLabel, H5pyCachedSpectrogramStore, MemoryMappedSpectrogramArchive, \
+    z_normalize, mel_filter_bank
+from speechless.tools import group, paginate, mkdir, first_duplicates, log
 
 
 class ParsingException(Exception):
@@ -36,24 +43,34 @@ class Corpus:
 
         self.sampled_training_example_count = sampled_training_example_count
         self.test_examples = test_examples
-        self.examples = training_examples + test_examples
 
         log("Training on {} examples, testing on {} examples.".format(
             len(self.training_examples), len(self.test_examples)))
         # a training sample has an id, unique identifier
-        duplicate_training_ids = duplicates(e.id for e in training_examples)
+        duplicate_training_ids = first_duplicates(e.id for e in training_examples)
         if len(duplicate_training_ids) > 0:
             raise ValueError("Duplicate ids in training examples: {}".format(duplicate_training_ids))
 
-        duplicate_test_ids = duplicates(e.id for e in test_examples)
+        duplicate_test_ids = first_duplicates(e.id for e in test_examples)
         if len(duplicate_test_ids) > 0:
             raise ValueError("Duplicate ids in test examples: {}".format(duplicate_test_ids))
 
-        overlapping_ids = duplicates(e.id for e in self.examples)
+        overlapping_ids = first_duplicates(e.id for e in chain(training_examples, test_examples))
 
         if len(overlapping_ids) > 0:
             raise ValueError("Overlapping training and test set: {}".format(overlapping_ids))
 
+    @property
+    def examples(self) -> List[LabeledExample]:
+        """
+        Builds a new list on each access, use example_count to only count them.
+        """
+        return self.training_examples + self.test_examples
+
+    @property
+    def example_count(self) -> int:
+        return len(self.training_examples) + len(self.test_examples)
+
     @abstractmethod
     def csv_rows(self) -> List[str]:
         raise NotImplementedError
@@ -70,50 +87,56 @@ class Corpus:
             for row in self.csv_rows():
                 writer.writerow(row)
 
+    csv_columns = ["id", "audio_file", "label", "phase", "positional_label"]
+
     def save(self, corpus_csv_file: Path, use_relative_audio_file_paths: bool = True):
-        import csv
-        # encoding: utf8
-        with corpus_csv_file.open('w', encoding='utf8') as opened_csv:
-            writer = csv.writer(opened_csv, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        import pandas
+
+        examples_and_phase = [(e, Phase.training) for e in self.training_examples] + \
+                             [(e, Phase.test) for e in self.test_examples]
 
-            examples_and_phase = [(e, Phase.training) for e in self.training_examples] + \
-                                 [(e, Phase.test) for e in self.test_examples]
+        rows = [(e.id, str(e.audio_file.relative_to(
+            corpus_csv_file.parent) if use_relative_audio_file_paths else e.audio_file),
+                 e.label, phase.value, e.positional_label.serialize() if e.positional_label else "")
+                for e, phase in examples_and_phase]
 
-            for e, phase in examples_and_phase:
-                writer.writerow(
-                    (e.id, str(e.audio_file.relative_to(
-                        corpus_csv_file.parent) if use_relative_audio_file_paths else e.audio_file),
-                     e.label, phase.value, e.positional_label.serialize() if e.positional_label else ""))
+        pandas.DataFrame(rows, columns=Corpus.csv_columns).to_csv(
+            str(corpus_csv_file), header=False, index=False, encoding='utf8')
 
     @staticmethod
     def load(corpus_csv_file: Path,
              sampled_training_example_count: Optional[int] = None) -> 'Corpus':
-        import csv
-        with corpus_csv_file.open(encoding='utf8') as opened_csv:
-            reader = csv.reader(opened_csv, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-
-            def to_absolute(audio_file_path: Path) -> Path:
-                return audio_file_path if audio_file_path.is_absolute() else Path(
-                    corpus_csv_file.parent) / audio_file_path
-
-            # positional_label: fine grained alignment?
-            examples = [
-                (
-                    LabeledExampleFromFile(
-                        # lazy mode to load the audio
-                        audio_file=to_absolute(Path(audio_file_path)), id=id, label=label,
-                        positional_label=None if positional_label == "" else PositionalLabel.deserialize(
-                            positional_label)), Phase[phase])
-                for id, audio_file_path, label, phase, positional_label in reader]
-
-            return Corpus(training_examples=[e for e, phase in examples if phase == Phase.training],
-                          test_examples=[e for e, phase in examples if phase == Phase.test],
-                          sampled_training_example_count=sampled_training_example_count)
+        import pandas
+        # parsed in bulk by pandas' C parser, keep_default_na to read empty positional labels as "" instead of NaN:
+        try:
+            rows = pandas.read_csv(str(corpus_csv_file), header=None, names=Corpus.csv_columns, dtype=str,
+                                   keep_default_na=False, encoding='utf8', engine='c')
+        except pandas.errors.EmptyDataError:
+            # a corpus without examples is saved as an empty file
+            rows = pandas.DataFrame(columns=Corpus.csv_columns)
+
+        def to_absolute(audio_file_path: Path) -> Path:
+            return audio_file_path if audio_file_path.is_absolute() else Path(
+                corpus_csv_file.parent) / audio_file_path
+
+        # positional_label: fine grained alignment?
+        examples = [
+            (
+                LabeledExampleFromFile(
+                    # lazy mode to load the audio
+                    audio_file=to_absolute(Path(audio_file_path)), id=id, label=label,
+                    positional_label=None if positional_label == "" else PositionalLabel.deserialize(
+                        positional_label)), Phase[phase])
+            for id, audio_file_path, label, phase, positional_label in rows.itertuples(index=False)]
+
+        return Corpus(training_examples=[e for e, phase in examples if phase == Phase.training],
+                      test_examples=[e for e, phase in examples if phase == Phase.test],
+                      sampled_training_example_count=sampled_training_example_count)
 
     K = TypeVar('Key')
 
     def grouped_by(self, key: Callable[[LabeledExample], K]) -> Dict[K, 'Corpus']:
-        examples_by_key = group(self.examples, key=key)
+        examples_by_key = group(chain(self.training_examples, self.test_examples), key=key)
         training_examples_by_key = group(self.training_examples, key=key)
         test_examples_by_key = group(self.test_examples, key=key)
 
@@ -145,7 +168,7 @@ class ComposedCorpus(Corpus):
     def summary(self) -> str:
         return "\n\n".join([corpus.summary() for corpus in self.corpora]) + \
                "\n\n {} total, {} training, {} test".format(
-                   len(self.examples), len(self.training_examples), len(self.test_examples))
+                   self.example_count, len(self.training_examples), len(self.test_examples))
 
 
 class TrainingTestSplit:
@@ -157,14 +180,16 @@ class TrainingTestSplit:
         [List[LabeledExample]], Tuple[List[LabeledExample], List[LabeledExample]]]:
         def split(examples: List[LabeledExample]) -> Tuple[List[LabeledExample], List[LabeledExample]]:
             examples_by_directory = group(examples, key=key_from_example)
-            directories = examples_by_directory.keys()
+            # sorted to keep the split independent of the order of examples:
+            directories = sorted(examples_by_directory.keys())
 
-            # split must be the same every time:
-            random.seed(42)
-            keys = set(random.sample(directories, int(training_share * len(directories))))
+            # split must be the same every time, a local generator leaves the global random state untouched:
+            keys = set(random.Random(42).sample(directories, int(training_share * len(directories))))
 
-            training_examples = [example for example in examples if key_from_example(example) in keys]
-            test_examples = [example for example in examples if key_from_example(example) not in keys]
+            training_examples = []
+            test_examples = []
+            for example in examples:
+                (training_examples if key_from_example(example) in keys else test_examples).append(example)
 
             return training_examples, test_examples
 
@@ -190,20 +215,40 @@ class TrainingTestSplit:
         [List[LabeledExampleFromFile]], Tuple[List[LabeledExampleFromFile], List[LabeledExampleFromFile]]]:
         def split(examples: List[LabeledExampleFromFile]) -> Tuple[
             List[LabeledExampleFromFile], List[LabeledExampleFromFile]]:
-            training_examples = [example for example in examples if example.audio_directory.name != test_directory_name]
-            test_examples = [example for example in examples if example.audio_directory.name == test_directory_name]
+            training_examples = []
+            test_examples = []
+            for example in examples:
+                is_test = example.audio_directory.name == test_directory_name
+                (test_examples if is_test else training_examples).append(example)
 
             return training_examples, test_examples
 
         return split
 
 
-def _cache_spectrogram(labeled_spectrogram: CachedLabeledSpectrogram) -> None:
-    labeled_spectrogram.z_normalized_transposed_spectrogram()
+def _calculate_spectrogram(example: LabeledSpectrogram) -> Tuple[str, ndarray]:
+    return example.id, example.z_normalized_transposed_spectrogram()
+
 
+def _calculate_spectrogram_from_raw_audio(
+        example_and_raw_audio: Tuple[LabeledExample, ndarray]) -> Tuple[str, ndarray]:
+    example, raw_audio = example_and_raw_audio
+    # this is a copy in the worker process, the audio was already loaded by the parent:
+    example.get_raw_audio = lambda: raw_audio
+    return _calculate_spectrogram(example)
 
-def _repair_cached_spectrogram_if_incorrect(labeled_spectrogram: CachedLabeledSpectrogram) -> None:
-    labeled_spectrogram.repair_cached_file_if_incorrect()
+
+def _with_raw_audio_loaded_ahead(examples: Iterable[LabeledExample], executor: Executor,
+                                 prefetch_count: int) -> Iterable[Tuple[LabeledExample, ndarray]]:
+    pending = deque()
+    for example in examples:
+        pending.append((example, executor.submit(example.get_raw_audio)))
+        if len(pending) > prefetch_count:
+            loaded_example, raw_audio = pending.popleft()
+            yield loaded_example, raw_audio.result()
+
+    for loaded_example, raw_audio in pending:
+        yield loaded_example, raw_audio.result()
 
 
 class LabeledSpectrogramBatchGenerator:
@@ -212,12 +257,21 @@ class LabeledSpectrogramBatchGenerator:
 
         self.batch_size = batch_size
         self.spectrogram_cache_directory = spectrogram_cache_directory
+        self.spectrogram_store = H5pyCachedSpectrogramStore.for_file(spectrogram_cache_directory / "spectrograms.h5")
         self.labeled_training_spectrograms = [
-            CachedLabeledSpectrogram(example, spectrogram_cache_directory=spectrogram_cache_directory)
+            CachedLabeledSpectrogram(example, spectrogram_store=self.spectrogram_store)
             for example in corpus.training_examples]
 
+        # test spectrograms are read every evaluation, so they are additionally kept in a memory-mapped archive,
+        # named by the test set because generators for sub-corpora share the cache directory:
+        test_set_hash = hashlib.sha1("\n".join(e.id for e in corpus.test_examples).encode('utf8')).hexdigest()[:16]
+        self.test_spectrogram_archive = MemoryMappedSpectrogramArchive(
+            data_file=spectrogram_cache_directory / "test-spectrograms-{}.npy".format(test_set_hash),
+            index_file=spectrogram_cache_directory / "test-spectrograms-{}-index.pickle".format(test_set_hash),
+            source_file=self.spectrogram_store.cache_file)
         self.labeled_test_spectrograms = [
-            CachedLabeledSpectrogram(example, spectrogram_cache_directory=spectrogram_cache_directory)
+            CachedLabeledSpectrogram(example, spectrogram_store=self.spectrogram_store,
+                                     archive=self.test_spectrogram_archive)
             for example in corpus.test_examples]
 
         self.labeled_spectrograms = self.labeled_training_spectrograms + self.labeled_test_spectrograms
@@ -226,24 +280,152 @@ class LabeledSpectrogramBatchGenerator:
         return self.labeled_spectrograms[:self.batch_size]
 
     def training_batches(self) -> Iterable[List[LabeledSpectrogram]]:
+        example_count = len(self.labeled_training_spectrograms)
+        if example_count < self.batch_size:
+            raise ValueError("Batch size {} exceeds the number of training examples {}.".format(
+                self.batch_size, example_count))
+
+        # each epoch visits every example at most once, the remainder smaller than a batch is skipped:
         while True:
-            yield random.sample(self.labeled_training_spectrograms, self.batch_size)
+            indices = numpy.random.permutation(example_count)
+            for start in range(0, example_count - self.batch_size + 1, self.batch_size):
+                yield [self.labeled_training_spectrograms[index] for index in indices[start:start + self.batch_size]]
 
     def test_batches(self) -> Iterable[List[LabeledSpectrogram]]:
         return paginate(self.labeled_test_spectrograms, self.batch_size)
 
-    def fill_cache(self, repair_incorrect: bool = False) -> None:
-        with Pool(processes=multiprocessing.cpu_count()) as pool:
-            total = len(self.labeled_spectrograms)
-            not_yet_cached = [s for s in self.labeled_spectrograms if not s.is_cached()]
-
-            to_calculate = self.labeled_spectrograms if repair_incorrect else not_yet_cached
-
-            log("Filling cache with {} spectrograms: {} already cached, {} to calculate.".format(
-                total, total - len(not_yet_cached), len(to_calculate)))
-            for index, labeled_spectrogram in enumerate(to_calculate):
-                pool.apply_async(_repair_cached_spectrogram_if_incorrect if repair_incorrect else _cache_spectrogram,
-                                 (labeled_spectrogram,))
-
-            pool.close()
-            pool.join()
+    @staticmethod
+    def _stacked(batch: List[LabeledSpectrogram], pad_to: Optional[int] = None) -> Tuple[ndarray, List[str]]:
+        spectrograms = [s.z_normalized_transposed_spectrogram() for s in batch]
+        time_step_count = max(spectrogram.shape[0] for spectrogram in spectrograms)
+        if pad_to is not None:
+            if pad_to < time_step_count:
+                raise ValueError("Cannot pad to {} time steps, batch contains a spectrogram with {}.".format(
+                    pad_to, time_step_count))
+            time_step_count = pad_to
+
+        stacked = numpy.zeros((len(spectrograms), time_step_count, spectrograms[0].shape[1]), dtype=numpy.float32)
+        for index, spectrogram in enumerate(spectrograms):
+            stacked[index, :spectrogram.shape[0]] = spectrogram
+
+        return stacked, [s.id for s in batch]
+
+    def stacked_training_batches(self, pad_to: Optional[int] = None) -> Iterable[Tuple[ndarray, List[str]]]:
+        """
+        Like training_batches, but yields the spectrograms zero-padded and stacked into an array with shape
+        (batch size, time, frequencies) together with the example ids.
+        """
+        return (self._stacked(batch, pad_to=pad_to) for batch in self.training_batches())
+
+    def stacked_test_batches(self, pad_to: Optional[int] = None) -> Iterable[Tuple[ndarray, List[str]]]:
+        """
+        Like test_batches, stacked as in stacked_training_batches.
+        """
+        return (self._stacked(batch, pad_to=pad_to) for batch in self.test_batches())
+
+    def _spectrograms_to_calculate(self, repair_incorrect: bool) -> List[CachedLabeledSpectrogram]:
+        cached_ids = self.spectrogram_store.ids()
+        # don't share an open cache file handle with forked workers:
+        self.spectrogram_store.close()
+        total = len(self.labeled_spectrograms)
+        not_yet_cached = [s for s in self.labeled_spectrograms if s.id not in cached_ids]
+
+        to_calculate = self.labeled_spectrograms if repair_incorrect else not_yet_cached
+
+        log("Filling cache with {} spectrograms: {} already cached, {} to calculate.".format(
+            total, total - len(not_yet_cached), len(to_calculate)))
+
+        return to_calculate
+
+    def _save_to_cache(self, id: str, spectrogram: ndarray, repair_incorrect: bool) -> None:
+        if repair_incorrect:
+            self.spectrogram_store.repair_if_incorrect(id, spectrogram)
+        else:
+            self.spectrogram_store[id] = spectrogram
+
+        # all spectrograms share one file, so a killed fill must not leave it inconsistent:
+        self.spectrogram_store.flush()
+
+    def _archive_test_spectrograms(self) -> None:
+        self.test_spectrogram_archive.write([s.id for s in self.labeled_test_spectrograms],
+                                            spectrogram_store=self.spectrogram_store)
+        self.spectrogram_store.close()
+
+    def fill_cache(self, repair_incorrect: bool = False, loading_thread_count: Optional[int] = None,
+                   prefetch_count: int = 64) -> None:
+        """
+        Audio is loaded by loading_thread_count threads (default: one per CPU) at most prefetch_count examples ahead
+        of the worker processes that calculate the spectrograms.
+        """
+        to_calculate = self._spectrograms_to_calculate(repair_incorrect)
+
+        # the pool is created first so that its processes are not forked while loading threads are running:
+        with Pool(processes=multiprocessing.cpu_count()) as pool, \
+                ThreadPoolExecutor(max_workers=loading_thread_count or multiprocessing.cpu_count()) as executor:
+            # IO-bound audio loading in threads overlaps with the calculation in worker processes,
+            # all writes to the single cache file happen here.
+            # Each task carries its raw audio, so tasks are sent one by one: larger chunks would be pulled from the
+            # prefetching generator as a whole, defeating the memory bound and delaying the first workers.
+            for id, spectrogram in pool.imap_unordered(
+                    _calculate_spectrogram_from_raw_audio,
+                    _with_raw_audio_loaded_ahead((s.original for s in to_calculate), executor,
+                                                 prefetch_count=prefetch_count),
+                    chunksize=1):
+                self._save_to_cache(id, spectrogram, repair_incorrect)
+
+        self._archive_test_spectrograms()
+
+    def fill_cache_gpu(self, batch_size: int = 128, loading_thread_count: Optional[int] = None,
+                       repair_incorrect: bool = False) -> None:
+        """
+        Like fill_cache, but calculates the spectrograms of batches of examples with torch on the GPU.
+        Requires torch and examples that share sample rate, fourier window length, hop length and mel frequency count.
+        """
+        import torch
+
+        to_calculate = [s.original for s in self._spectrograms_to_calculate(repair_incorrect)]
+        if not to_calculate:
+            self._archive_test_spectrograms()
+            return
+
+        first = to_calculate[0]
+        parameters = (first.sample_rate, first.fourier_window_length, first.hop_length, first.mel_frequency_count)
+        if any((e.sample_rate, e.fourier_window_length, e.hop_length, e.mel_frequency_count) != parameters
+               for e in to_calculate):
+            raise ValueError("Examples must share their spectrogram parameters to be calculated in batches.")
+
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        window = torch.hann_window(first.fourier_window_length, device=device)
+        # copied because the memoized filter is read-only, which torch.from_numpy does not support:
+        mel_filter = torch.from_numpy(mel_filter_bank(
+            sample_rate=first.sample_rate, fourier_window_length=first.fourier_window_length,
+            mel_frequency_count=first.mel_frequency_count).copy()).to(device)
+        # same as in LabeledExample._power_level_from_power_spectrogram:
+        min_power = 10 ** (-150 / 10)
+
+        # loading audio is IO-bound and therefore done by threads:
+        with ThreadPoolExecutor(max_workers=loading_thread_count or multiprocessing.cpu_count()) as executor:
+            for batch in paginate(to_calculate, batch_size):
+                raw_audios = list(executor.map(lambda example: example.get_raw_audio(), batch))
+
+                # each example is padded on its own like librosa.stft(center=True) does, so that the zeros filling
+                # up the batch behind shorter examples only fall into frames that are cut off afterwards:
+                centered_audios = [numpy.pad(audio, first.fourier_window_length // 2, mode=first.stft_pad_mode)
+                                   for audio in raw_audios]
+                padded = numpy.zeros((len(batch), max(len(audio) for audio in centered_audios)), dtype=numpy.float32)
+                for index, audio in enumerate(centered_audios):
+                    padded[index, :len(audio)] = audio
+
+                with torch.no_grad():
+                    complex_spectrograms = torch.stft(
+                        torch.from_numpy(padded).to(device), n_fft=first.fourier_window_length,
+                        hop_length=first.hop_length, window=window, center=False, return_complex=True)
+                    power_levels = 10 * torch.log10(torch.clamp(complex_spectrograms.abs() ** 2, min=min_power))
+                    mel_power_levels = torch.matmul(mel_filter, power_levels).cpu().numpy()
+
+                for example, audio, mel_power_level in zip(batch, raw_audios, mel_power_levels):
+                    time_step_count = 1 + len(audio) // first.hop_length
+                    self._save_to_cache(example.id, z_normalize(mel_power_level[:, :time_step_count].T),
+                                        repair_incorrect)
+
+        self._archive_test_spectrograms()
@@ -206,7 +206,7 @@ class LibriSpeechCorpus(Corpus):
                  len(self.audio_ids_without_label), str(self.audio_ids_without_label[:10]),
                  len(self.label_ids_without_audio), self.label_ids_without_audio[:10],
                  self.tag_summary,
-                 len(self.examples),
+                 self.example_count,
                  len(self.invalid_examples_texts), self.invalid_examples_summary,
                  len(self.empty_examples), [e.id for e in self.empty_examples[:10]],
                  self.duplicate_label_count, self.most_duplicated_labels,
@@ -237,7 +237,7 @@ class LibriSpeechCorpus(Corpus):
 
             "Removed label tags: {}\n".format(self.tag_summary) if self.tag_summary != "" else "",
             self.invalid_examples_summary,
-            len(self.examples),  # self.total_duration_in_h,
+            self.example_count,  # self.total_duration_in_h,
             len(self.invalid_examples_texts),
             len(self.empty_examples),
             len(self.too_long_examples),  # self.total_duration_of_too_long_examples_in_h,
@@ -278,7 +278,7 @@ class LibriSpeechCorpus(Corpus):
     @lazy
     def some_original_sample_rates(self):
         return [e.original_sample_rate for e in
-                random.sample(self.examples, min(50, len(self.examples)))]
+                random.sample(self.examples, min(50, self.example_count))]
 
     @lazy
     def file_extensions(self):
@@ -298,7 +298,7 @@ class LibriSpeechCorpus(Corpus):
 
     @lazy
     def duplicate_label_count(self):
-        return len(self.examples) - len(set(e.label for e in self.examples))
+        return self.example_count - len(set(e.label for e in self.examples))
 
     @lazy
     def most_duplicated_labels(self):
@@ -1,20 +1,73 @@
 import math
 from abc import ABCMeta, abstractmethod
 from enum import Enum
+from functools import lru_cache
 from pathlib import Path
 
 import audioread
+import h5py
 import librosa
 import numpy
 import os
+import pickle
+import tempfile
+import threading
 from lazy import lazy
-from numpy import ndarray, mean, std, vectorize, dot
-from typing import List, Optional, Tuple, Callable
+from numpy import ndarray, mean, dot
+from typing import List, Optional, Tuple, Callable, Set, Dict
 
-from speechless.tools import name_without_extension, mkdir, write_text, log
+from speechless.tools import name_without_extension, log
 
 # This is the place where pyaudio is heavily used
 
+
+def _use_pyfftw_for_librosa_if_available() -> None:
+    """
+    FFTW plans are cached per transform shape, which pays off for the identical transforms done for all examples.
+    """
+    try:
+        import pyfftw.interfaces.cache
+        import pyfftw.interfaces.numpy_fft
+    except ImportError:
+        return
+
+    if not hasattr(librosa, "set_fftlib"):
+        return
+
+    pyfftw.interfaces.cache.enable()
+    librosa.set_fftlib(pyfftw.interfaces.numpy_fft)
+
+
+_use_pyfftw_for_librosa_if_available()
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# numba is a dependency of librosa, so in practice this kernel is used and librosa.power_to_db is only the fallback
+if njit is not None:
+    # not parallel: it already runs in one process per CPU when filling the cache,
+    # and numba's threading layers are not safe to use after forking
+    @njit(fastmath=True, cache=True)
+    def _power_level_into(flat_spectrogram: ndarray, flat_power_level: ndarray, min_decibel: float) -> None:
+        for i in range(flat_spectrogram.shape[0]):
+            power = flat_spectrogram[i]
+            flat_power_level[i] = min_decibel if power <= 0 else max(10 * math.log10(power), min_decibel)
+
+    def _jit_compiled_power_level(spectrogram: ndarray, min_decibel: float) -> ndarray:
+        """
+        Same as librosa.power_to_db with amin = 10 ** (min_decibel / 10), but as a single fused pass.
+        """
+        # librosa.stft returns Fortran-ordered arrays: walk both arrays in memory order instead of by index,
+        # empty_like keeps the memory order, so the flat output is a view:
+        power_level = numpy.empty_like(spectrogram)
+        _power_level_into(spectrogram.ravel(order='K'), power_level.ravel(order='K'), min_decibel)
+        return power_level
+else:
+    _jit_compiled_power_level = None
+
+
 # how we devide the frequency bank, linear or mf
 class SpectrogramFrequencyScale(Enum):
     linear = "linear"
@@ -28,7 +81,22 @@ class SpectrogramType(Enum):
 
 
 def z_normalize(array: ndarray) -> ndarray:
-    return (array - mean(array)) / std(array)
+    # one C-contiguous copy that is scaled in place,
+    # the standard deviation is taken from the centered copy instead of recalculating the mean in numpy.std:
+    centered = numpy.subtract(array, mean(array), order='C')
+    flat_centered = centered.ravel()
+    centered *= 1 / numpy.sqrt(dot(flat_centered, flat_centered) / flat_centered.size)
+    return centered
+
+
+@lru_cache(maxsize=32)
+def mel_filter_bank(sample_rate: int, fourier_window_length: int, mel_frequency_count: int) -> ndarray:
+    """
+    The filter bank is shared between all examples with the same parameters and therefore read-only.
+    """
+    mel_filter = librosa.filters.mel(sr=sample_rate, n_fft=fourier_window_length, n_mels=mel_frequency_count)
+    mel_filter.flags.writeable = False
+    return mel_filter
 
 
 class PositionalLabel:
@@ -76,6 +144,10 @@ class LabeledSpectrogram:
 
 
 class LabeledExample(LabeledSpectrogram):
+    # explicit because librosa's default changed from 'reflect' to 'constant' in 0.10,
+    # 'reflect' is what the trained models have seen:
+    stft_pad_mode = 'reflect'
+
     def __init__(self,
                  get_raw_audio: Callable[[], ndarray],
                  sample_rate: int = 16000,
@@ -103,22 +175,25 @@ class LabeledExample(LabeledSpectrogram):
         return self.label_with_tags.count(tag)
 
     def _power_spectrogram(self) -> ndarray:
-        return self._amplitude_spectrogram() ** 2
+        amplitude_spectrogram = self._amplitude_spectrogram()
+        # squared in place to avoid another spectrogram-sized allocation:
+        return numpy.square(amplitude_spectrogram, out=amplitude_spectrogram)
 
     def _amplitude_spectrogram(self) -> ndarray:
         return abs(self._complex_spectrogram())
 
     def _complex_spectrogram(self) -> ndarray:
-        return librosa.stft(y=self.get_raw_audio(), n_fft=self.fourier_window_length, hop_length=self.hop_length)
+        return librosa.stft(y=self.get_raw_audio(), n_fft=self.fourier_window_length, hop_length=self.hop_length,
+                            pad_mode=self.stft_pad_mode)
 
     def mel_frequencies(self) -> List[float]:
         # according to librosa.filters.mel code
         return librosa.mel_frequencies(self.mel_frequency_count + 2, fmax=self.sample_rate / 2)
 
     def _convert_spectrogram_to_mel_scale(self, linear_frequency_spectrogram: ndarray) -> ndarray:
-        return dot(
-            librosa.filters.mel(sr=self.sample_rate, n_fft=self.fourier_window_length, n_mels=self.mel_frequency_count),
-            linear_frequency_spectrogram)
+        return dot(mel_filter_bank(sample_rate=self.sample_rate, fourier_window_length=self.fourier_window_length,
+                                   mel_frequency_count=self.mel_frequency_count),
+                   linear_frequency_spectrogram)
 
     def highest_detectable_frequency(self) -> float:
         return self.sample_rate / 2
@@ -161,13 +236,13 @@ class LabeledExample(LabeledSpectrogram):
     @staticmethod
     def _power_level_from_power_spectrogram(spectrogram: ndarray) -> ndarray:
         # default value for min_decibel found by experiment (all values except for 0s were above this bound)
-        def power_to_decibel(x, min_decibel: float = -150) -> float:
-            if x == 0:
-                return min_decibel
-            l = 10 * math.log10(x)
-            return min_decibel if l < min_decibel else l
+        min_decibel = -150
+
+        if _jit_compiled_power_level is not None:
+            return _jit_compiled_power_level(spectrogram, min_decibel)
 
-        return vectorize(power_to_decibel)(spectrogram)
+        # powers below amin (including 0s) are clamped to it and therefore end up at min_decibel:
+        return librosa.power_to_db(spectrogram, ref=1.0, amin=10 ** (min_decibel / 10), top_db=None)
 
     def reconstructed_audio_from_spectrogram(self) -> ndarray:
         return librosa.istft(self._complex_spectrogram(), win_length=self.fourier_window_length,
@@ -200,13 +275,17 @@ class LabeledExampleFromFile(LabeledExample):
         self.audio_file = audio_file
 
         super().__init__(
-            id=id, get_raw_audio=lambda: librosa.load(str(self.audio_file), sr=self.sample_rate)[0],
+            id=id, get_raw_audio=self._load_raw_audio,
             label=label, sample_rate=sample_rate_to_convert_to,
             fourier_window_length=fourier_window_length, hop_length=hop_length, mel_frequency_count=mel_frequency_count,
             label_with_tags=label_with_tags, positional_label=positional_label)
 
-    @property
-    def audio_directory(self):
+    # a bound method instead of a lambda to keep examples picklable for multiprocessing:
+    def _load_raw_audio(self) -> ndarray:
+        return librosa.load(str(self.audio_file), sr=self.sample_rate)[0]
+
+    @lazy
+    def audio_directory(self) -> Path:
         return Path(self.audio_file.parent)
 
     @lazy
@@ -242,14 +321,228 @@ class LabeledExampleFromFile(LabeledExample):
         # fine grained samples, each section corresponds to one sample
         return [section(label, start, end) for label, (start, end) in self.positional_label.labeled_sections]
 
+
+class H5pyCachedSpectrogramStore:
+    """
+    Keeps the spectrograms of all examples in a single HDF5 file, one dataset per example id,
+    instead of one file per example.
+
+    Spectrograms are expected to be z-normalized and are stored clipped to
+    [-quantization_bound, quantization_bound] and quantized to uint8, a quarter of the size of float32.
+    """
+
+    quantization_bound = 6.
+    quantization_levels = 255
+
+    def __init__(self, cache_file: Path):
+        self.cache_file = cache_file
+        self._file = None
+        self._is_writable = False
+        # the handle is shared between threads, e. g. the batch generator thread of keras and the main thread,
+        # and reopening it for writing invalidates datasets that are being read:
+        self._lock = threading.RLock()
+
+    _stores_by_cache_file = {}
+    _stores_lock = threading.Lock()
+
+    @staticmethod
+    def for_file(cache_file: Path) -> 'H5pyCachedSpectrogramStore':
+        """
+        HDF5 refuses to open a file for writing while another handle in the same process has it open for reading,
+        so all users of a cache file share one store (and therefore one handle).
+        """
+        key = os.path.realpath(str(cache_file))
+        with H5pyCachedSpectrogramStore._stores_lock:
+            stores = H5pyCachedSpectrogramStore._stores_by_cache_file
+            if key not in stores:
+                stores[key] = H5pyCachedSpectrogramStore(cache_file)
+
+            return stores[key]
+
+    def _opened(self, writable: bool = False) -> h5py.File:
+        if self._file is not None and (self._is_writable or not writable):
+            return self._file
+
+        self._close()
+        # libver 'latest' is required to open the file in single-writer-multiple-reader (swmr) mode later on:
+        self._file = h5py.File(str(self.cache_file), 'a', libver='latest') if writable else \
+            h5py.File(str(self.cache_file), 'r', libver='latest', swmr=True)
+        self._is_writable = writable
+
+        return self._file
+
+    def _close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self) -> None:
+        with self._lock:
+            self._close()
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._file is not None and self._is_writable:
+                self._file.flush()
+
+    def ids(self) -> Set[str]:
+        with self._lock:
+            if self._file is None and not self.cache_file.exists():
+                return set()
+
+            return set(self._opened().keys())
+
+    def __contains__(self, id: str) -> bool:
+        with self._lock:
+            if self._file is None and not self.cache_file.exists():
+                return False
+
+            return id in self._opened()
+
+    def shape(self, id: str) -> Tuple[int, ...]:
+        with self._lock:
+            return self._opened()[id].shape
+
+    def __getitem__(self, id: str) -> ndarray:
+        with self._lock:
+            dataset = self._opened()[id]
+            quantized = dataset[()]
+            scale = dataset.attrs["scale"]
+            offset = dataset.attrs["offset"]
+
+        # scalars cast as well, numpy >= 2 would otherwise promote the result to float64:
+        return quantized.astype(numpy.float32) * numpy.float32(scale) + numpy.float32(offset)
+
+    def __setitem__(self, id: str, spectrogram: ndarray) -> None:
+        bound = self.quantization_bound
+        scale = 2 * bound / self.quantization_levels
+        quantized = numpy.round((numpy.clip(spectrogram, -bound, bound) + bound) / scale).astype(numpy.uint8)
+
+        with self._lock:
+            file = self._opened(writable=True)
+            if id in file:
+                del file[id]
+            dataset = file.create_dataset(id, data=quantized)
+            dataset.attrs["scale"] = numpy.float32(scale)
+            dataset.attrs["offset"] = numpy.float32(-bound)
+
+    def repair_if_incorrect(self, id: str, calculated: ndarray) -> None:
+        with self._lock:
+            if id in self:
+                try:
+                    numpy.testing.assert_almost_equal(
+                        numpy.clip(calculated, -self.quantization_bound, self.quantization_bound), self[id],
+                        decimal=1)
+                    return
+                except AssertionError as e:
+                    log("Replacing incorrect cached spectrogram {} in {}: {}".format(id, self.cache_file, e))
+
+            self[id] = calculated
+
+
+class MemoryMappedSpectrogramArchive:
+    """
+    Spectrograms of a fixed set of examples concatenated along the time axis in a single float16 .npy file,
+    memory-mapped for reading, together with an index from example id to its range of time steps.
+
+    If a source file is given, the archive is only used while it is newer than that file.
+    """
+
+    def __init__(self, data_file: Path, index_file: Path, source_file: Optional[Path] = None):
+        self.data_file = data_file
+        self.index_file = index_file
+        self.source_file = source_file
+        self._data = None
+        self._time_step_ranges_by_id = None
+
+    def write(self, ids: List[str], spectrogram_store: H5pyCachedSpectrogramStore) -> None:
+        """
+        Files are written under temporary names and then replaced, so archives that are already memory-mapped
+        (e. g. by another batch generator) keep reading their old, unchanged files.
+        """
+        if not ids:
+            return
+
+        # closed first so that the store file is not modified after the archive is written:
+        spectrogram_store.close()
+
+        time_step_ranges_by_id = {}
+        time_step_count = 0
+        for id in ids:
+            start = time_step_count
+            time_step_count += spectrogram_store.shape(id)[0]
+            time_step_ranges_by_id[id] = (start, time_step_count)
+
+        temporary_data_file = self._temporary_file_next_to(self.data_file)
+        data = numpy.lib.format.open_memmap(str(temporary_data_file), mode='w+', dtype=numpy.float16,
+                                            shape=(time_step_count, spectrogram_store.shape(ids[0])[1]))
+        for id, (start, end) in time_step_ranges_by_id.items():
+            data[start:end] = spectrogram_store[id]
+        data.flush()
+        del data
+
+        temporary_index_file = self._temporary_file_next_to(self.index_file)
+        with temporary_index_file.open('wb') as opened_index:
+            pickle.dump(time_step_ranges_by_id, opened_index)
+
+        os.replace(str(temporary_data_file), str(self.data_file))
+        os.replace(str(temporary_index_file), str(self.index_file))
+
+        self._data = None
+        self._time_step_ranges_by_id = None
+
+    @staticmethod
+    def _temporary_file_next_to(file: Path) -> Path:
+        descriptor, temporary_file = tempfile.mkstemp(dir=str(file.parent), prefix=file.name, suffix=".tmp")
+        os.close(descriptor)
+        return Path(temporary_file)
+
+    def _loaded(self) -> Tuple[ndarray, Dict[str, Tuple[int, int]]]:
+        if self._data is None:
+            with self.index_file.open('rb') as opened_index:
+                self._time_step_ranges_by_id = pickle.load(opened_index)
+            self._data = numpy.load(str(self.data_file), mmap_mode='r')
+
+        return self._data, self._time_step_ranges_by_id
+
+    def _is_up_to_date(self) -> bool:
+        if not (self.data_file.exists() and self.index_file.exists()):
+            return False
+
+        if self.source_file is None:
+            return True
+
+        # stale if the source was deleted or changed after the archive was written:
+        return self.source_file.exists() and self.source_file.stat().st_mtime <= self.index_file.stat().st_mtime
+
+    def __contains__(self, id: str) -> bool:
+        if not self._is_up_to_date():
+            self._data = None
+            self._time_step_ranges_by_id = None
+            return False
+
+        return id in self._loaded()[1]
+
+    def __getitem__(self, id: str) -> ndarray:
+        data, time_step_ranges_by_id = self._loaded()
+        start, end = time_step_ranges_by_id[id]
+        # a single contiguous read, converted to the same type as spectrograms from the store:
+        return data[start:end].astype(numpy.float32)
+
+
 # use pre-compuated spectrogram to speed up the training
 class CachedLabeledSpectrogram(LabeledSpectrogram):
-    def __init__(self, original: LabeledSpectrogram, spectrogram_cache_directory: Path):
+    def __init__(self, original: LabeledSpectrogram, spectrogram_store: H5pyCachedSpectrogramStore,
+                 archive: Optional[MemoryMappedSpectrogramArchive] = None):
         super().__init__(id=original.id, label=original.label)
         self.original = original
-        self.spectrogram_cache_file = spectrogram_cache_directory / "{}.npy".format(original.id)
+        self.spectrogram_store = spectrogram_store
+        self.archive = archive
 
     def z_normalized_transposed_spectrogram(self) -> ndarray:
+        if self.archive is not None and self.id in self.archive:
+            return self.archive[self.id]
+
         if not self.is_cached():
             return self._calculate_and_save_spectrogram()
 
@@ -257,41 +550,15 @@ class CachedLabeledSpectrogram(LabeledSpectrogram):
 
     def _load_from_cache(self):
         try:
-            return numpy.load(str(self.spectrogram_cache_file))
-        except ValueError:
-            log("Recalculating cached file {} because loading failed.".format(self.spectrogram_cache_file))
+            return self.spectrogram_store[self.id]
+        except (ValueError, OSError, KeyError) as e:
+            log("Recalculating cached spectrogram {} because loading failed: {}".format(self.id, e))
             return self._calculate_and_save_spectrogram()
 
     def _calculate_and_save_spectrogram(self):
-        spectrogram = self.original.z_normalized_transposed_spectrogram()
-        self._save_to_cache(spectrogram)
-        return spectrogram
-
-    def _save_to_cache(self, spectrogram: ndarray):
-        numpy.save(str(self.spectrogram_cache_file), spectrogram)
+        self.spectrogram_store[self.id] = self.original.z_normalized_transposed_spectrogram()
+        # read back to return the same quantized values as all later reads:
+        return self.spectrogram_store[self.id]
 
     def is_cached(self):
-        return self.spectrogram_cache_file.exists()
-
-    def repair_cached_file_if_incorrect(self):
-        if not self.is_cached():
-            self._calculate_and_save_spectrogram()
-            return
-
-        from_cache = self._load_from_cache()
-        calculated = self.original.z_normalized_transposed_spectrogram()
-        try:
-            numpy.testing.assert_almost_equal(calculated, from_cache, decimal=1)
-        except AssertionError as e:
-            self.move_incorrect_cached_file_to_backup_location_and_save_error(str(e))
-            self._save_to_cache(calculated)
-
-    def move_incorrect_cached_file_to_backup_location_and_save_error(self, error_text: str):
-        parent_directory = Path(self.spectrogram_cache_file.parent)
-        incorrect_cached_backup_directory = Path(parent_directory.parent / (parent_directory.name + "-incorrect"))
-        mkdir(incorrect_cached_backup_directory)
-        incorrect_backup_file = incorrect_cached_backup_directory / self.spectrogram_cache_file.name
-        incorrect_backup_message_file = incorrect_cached_backup_directory / (
-            name_without_extension(self.spectrogram_cache_file) + "-error.txt")
-        write_text(incorrect_backup_message_file, error_text)
-        self.spectrogram_cache_file.rename(incorrect_backup_file)
+        return self.id in self.spectrogram_store
@@ -0,0 +1,43 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from speechless.corpus import Corpus
+from speechless.labeled_example import LabeledExampleFromFile, PositionalLabel
+
+
+class CorpusTest(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.corpus_csv_file = Path(self.directory.name) / "corpus.csv"
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def example(self, id: str, label: str, positional_label=None) -> LabeledExampleFromFile:
+        return LabeledExampleFromFile(Path(self.directory.name) / "audio" / (id + ".flac"), id=id, label=label,
+                                      positional_label=positional_label)
+
+    def test_save_and_load(self):
+        positional_label = PositionalLabel([("einmal", (0, 0.55555)), ("von, \"so\"", (0.55555, 0.8))])
+        Corpus(training_examples=[self.example("a", "einmal von so", positional_label=positional_label),
+                                  self.example("b", "with, comma")],
+               test_examples=[self.example("c", "test")]).save(self.corpus_csv_file)
+
+        loaded = Corpus.load(self.corpus_csv_file)
+
+        self.assertEqual(["a", "b"], [e.id for e in loaded.training_examples])
+        self.assertEqual(["c"], [e.id for e in loaded.test_examples])
+        self.assertEqual(["einmal von so", "with, comma", "test"], [e.label for e in loaded.examples])
+        self.assertEqual(Path(self.directory.name) / "audio" / "b.flac", loaded.training_examples[1].audio_file)
+        self.assertEqual(positional_label.labeled_sections,
+                         loaded.training_examples[0].positional_label.labeled_sections)
+        self.assertIsNone(loaded.training_examples[1].positional_label)
+
+    def test_save_and_load_without_examples(self):
+        Corpus(training_examples=[], test_examples=[]).save(self.corpus_csv_file)
+
+        loaded = Corpus.load(self.corpus_csv_file)
+
+        self.assertEqual([], loaded.training_examples)
+        self.assertEqual([], loaded.test_examples)
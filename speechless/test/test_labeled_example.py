@@ -14,7 +14,7 @@ class LabeledExampleTest(TestCase):
         example = corpus.examples[0]
         mel_power_spectrogram = librosa.feature.melspectrogram(
             y=example.get_raw_audio(), n_fft=example.fourier_window_length, hop_length=example.hop_length,
-            sr=example.sample_rate)
+            sr=example.sample_rate, pad_mode=example.stft_pad_mode)
 
         self.assertTrue(np.array_equal(mel_power_spectrogram,
                                        example.spectrogram(type=SpectrogramType.power,
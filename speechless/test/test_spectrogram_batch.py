@@ -1,9 +1,84 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
 from unittest import TestCase
 
-from speechless.tools import paginate
+import numpy as np
+
+from speechless.corpus import Corpus, LabeledSpectrogramBatchGenerator
+from speechless.labeled_example import LabeledSpectrogram
+from speechless.tools import paginate, first_duplicates, group
 
 
 class ToolsTest(TestCase):
     def test_paginate(self):
         a = paginate([1, 2, 3], 2)
         self.assertEqual(list(a), [[1, 2], [3, ]])
+
+    def test_paginate_iterator(self):
+        self.assertEqual(list(paginate(iter(range(4)), 2)), [[0, 1], [2, 3]])
+        self.assertEqual(list(paginate([], 2)), [])
+
+    def test_first_duplicates(self):
+        self.assertEqual(first_duplicates([1, 2, 1, 3, 2, 1]), [1, 2, 1])
+        self.assertEqual(first_duplicates([1, 2, 1, 3, 2, 1], limit=2), [1, 2])
+        self.assertEqual(first_duplicates(iter([1, 2, 3])), [])
+
+    def test_group(self):
+        grouped = group(["bb", "a", "c", "dd", "eee"], key=len, value=str.upper)
+        self.assertEqual(list(grouped.items()), [(2, ("BB", "DD")), (1, ("A", "C")), (3, ("EEE",))])
+
+
+class ConstantLabeledSpectrogram(LabeledSpectrogram):
+    def __init__(self, id: str, time_step_count: int):
+        super().__init__(id=id, label="label")
+        self.spectrogram = np.ones((time_step_count, 4), dtype=np.float32)
+
+    def z_normalized_transposed_spectrogram(self):
+        return self.spectrogram
+
+
+class LabeledSpectrogramBatchGeneratorTest(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        corpus = Corpus(training_examples=[ConstantLabeledSpectrogram(str(i), time_step_count=i + 1)
+                                           for i in range(10)],
+                        test_examples=[ConstantLabeledSpectrogram("test" + str(i), time_step_count=i + 1)
+                                       for i in range(3)])
+        self.generator = LabeledSpectrogramBatchGenerator(
+            corpus, spectrogram_cache_directory=Path(self.directory.name), batch_size=3)
+
+    def tearDown(self):
+        self.generator.spectrogram_store.close()
+        self.directory.cleanup()
+
+    def test_training_batches_visit_each_example_at_most_once_per_epoch(self):
+        batches = self.generator.training_batches()
+        ids = [s.id for _ in range(10 // 3) for s in next(batches)]
+
+        self.assertEqual(9, len(ids))
+        self.assertEqual(len(ids), len(set(ids)))
+
+    def test_stacked_test_batches(self):
+        stacked, ids = next(self.generator.stacked_test_batches())
+
+        self.assertEqual(["test0", "test1", "test2"], ids)
+        self.assertEqual((3, 3, 4), stacked.shape)
+        np.testing.assert_almost_equal(np.ones((2, 4)), stacked[1, :2], decimal=1)
+        np.testing.assert_equal(np.zeros((1, 4)), stacked[1, 2:])
+        np.testing.assert_equal(np.zeros((2, 4)), stacked[0, 1:])
+
+    def test_stacked_test_batches_padded(self):
+        stacked, ids = next(self.generator.stacked_test_batches(pad_to=5))
+
+        self.assertEqual((3, 5, 4), stacked.shape)
+        np.testing.assert_equal(np.zeros((2, 4)), stacked[2, 3:])
+
+    def test_stacked_batches_pad_to_shorter_than_longest(self):
+        with self.assertRaises(ValueError):
+            next(self.generator.stacked_test_batches(pad_to=2))
+
+    def test_stacked_training_batches(self):
+        stacked, ids = next(self.generator.stacked_training_batches())
+
+        self.assertEqual(3, len(ids))
+        self.assertEqual((3, max(int(id) + 1 for id in ids), 4), stacked.shape)
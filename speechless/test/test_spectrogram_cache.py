@@ -0,0 +1,169 @@
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+from unittest import TestCase, skipIf
+
+import librosa
+import numpy as np
+
+from speechless.labeled_example import H5pyCachedSpectrogramStore, MemoryMappedSpectrogramArchive, LabeledExample, \
+    LabeledSpectrogram, CachedLabeledSpectrogram, _jit_compiled_power_level
+
+
+class H5pyCachedSpectrogramStoreTest(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.cache_file = Path(self.directory.name) / "spectrograms.h5"
+
+    def tearDown(self):
+        H5pyCachedSpectrogramStore.for_file(self.cache_file).close()
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        store = H5pyCachedSpectrogramStore.for_file(self.cache_file)
+        self.assertEqual(set(), store.ids())
+        self.assertFalse("a" in store)
+
+        spectrogram = np.random.uniform(-5, 5, (20, 8)).astype(np.float32)
+        store["a"] = spectrogram
+
+        self.assertEqual({"a"}, store.ids())
+        self.assertTrue("a" in store)
+        np.testing.assert_almost_equal(spectrogram, store["a"], decimal=1)
+        self.assertEqual(np.float32, store["a"].dtype)
+
+    def test_repair_if_incorrect(self):
+        store = H5pyCachedSpectrogramStore.for_file(self.cache_file)
+        store["a"] = np.zeros((20, 8), dtype=np.float32)
+
+        correct = np.ones((20, 8), dtype=np.float32)
+        store.repair_if_incorrect("a", correct)
+        np.testing.assert_almost_equal(correct, store["a"], decimal=1)
+
+        store.repair_if_incorrect("b", correct)
+        self.assertEqual({"a", "b"}, store.ids())
+
+    def test_write_while_another_user_reads(self):
+        reading = H5pyCachedSpectrogramStore.for_file(self.cache_file)
+        writing = H5pyCachedSpectrogramStore.for_file(self.cache_file)
+        self.assertIs(reading, writing)
+
+        writing["a"] = np.zeros((20, 8), dtype=np.float32)
+        reading["a"]
+        writing["b"] = np.ones((20, 8), dtype=np.float32)
+
+        np.testing.assert_almost_equal(np.ones((20, 8)), reading["b"], decimal=1)
+
+    def test_reads_and_writes_from_several_threads(self):
+        store = H5pyCachedSpectrogramStore.for_file(self.cache_file)
+        store["a"] = np.ones((20, 8), dtype=np.float32)
+
+        def read_or_write(index: int):
+            if index % 2 == 0:
+                store[str(index)] = np.zeros((20, 8), dtype=np.float32)
+            else:
+                np.testing.assert_almost_equal(np.ones((20, 8)), store["a"], decimal=1)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(read_or_write, range(200)))
+
+        self.assertEqual(101, len(store.ids()))
+
+    def test_recalculate_unreadable_cached_spectrogram(self):
+        store = H5pyCachedSpectrogramStore.for_file(self.cache_file)
+        cached = CachedLabeledSpectrogram(ConstantLabeledSpectrogram("a"), spectrogram_store=store)
+        store["a"] = np.zeros((20, 8), dtype=np.float32)
+        del store._opened(writable=True)["a"].attrs["scale"]
+
+        np.testing.assert_almost_equal(np.ones((20, 8)), cached.z_normalized_transposed_spectrogram(), decimal=1)
+        np.testing.assert_almost_equal(np.ones((20, 8)), store["a"], decimal=1)
+
+
+class ConstantLabeledSpectrogram(LabeledSpectrogram):
+    def __init__(self, id: str):
+        super().__init__(id=id, label="label")
+
+    def z_normalized_transposed_spectrogram(self):
+        return np.ones((20, 8), dtype=np.float32)
+
+
+class MemoryMappedSpectrogramArchiveTest(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        directory = Path(self.directory.name)
+        self.store = H5pyCachedSpectrogramStore.for_file(directory / "spectrograms.h5")
+        self.archive = MemoryMappedSpectrogramArchive(data_file=directory / "test.npy",
+                                                      index_file=directory / "test-index.pickle",
+                                                      source_file=self.store.cache_file)
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def test_write_and_read(self):
+        a = np.random.uniform(-5, 5, (20, 8)).astype(np.float32)
+        b = np.random.uniform(-5, 5, (7, 8)).astype(np.float32)
+        self.store["a"] = a
+        self.store["b"] = b
+
+        self.archive.write(["a", "b"], spectrogram_store=self.store)
+
+        self.assertTrue("a" in self.archive)
+        self.assertFalse("c" in self.archive)
+        self.assertEqual((7, 8), self.archive["b"].shape)
+        self.assertEqual(np.float32, self.archive["b"].dtype)
+        np.testing.assert_almost_equal(a, self.archive["a"], decimal=1)
+        np.testing.assert_almost_equal(b, self.archive["b"], decimal=1)
+
+    def test_rewrite_keeps_mapped_data_readable(self):
+        self.store["a"] = np.zeros((20, 8), dtype=np.float32)
+        self.archive.write(["a"], spectrogram_store=self.store)
+        self.assertTrue("a" in self.archive)
+        mapped, _ = self.archive._loaded()
+
+        self.store["a"] = np.ones((20, 8), dtype=np.float32)
+        self.archive.write(["a"], spectrogram_store=self.store)
+
+        np.testing.assert_almost_equal(np.zeros((20, 8)), mapped, decimal=1)
+        self.assertTrue("a" in self.archive)
+        np.testing.assert_almost_equal(np.ones((20, 8)), self.archive["a"], decimal=1)
+
+    def test_stale_when_store_changed_or_deleted(self):
+        self.store["a"] = np.zeros((20, 8), dtype=np.float32)
+        self.archive.write(["a"], spectrogram_store=self.store)
+        self.assertTrue("a" in self.archive)
+
+        self.store["b"] = np.zeros((20, 8), dtype=np.float32)
+        self.store.close()
+        self.assertFalse("a" in self.archive)
+
+        self.archive.write(["a"], spectrogram_store=self.store)
+        self.assertTrue("a" in self.archive)
+
+        self.store.close()
+        self.store.cache_file.unlink()
+        self.assertFalse("a" in self.archive)
+
+    def test_no_examples(self):
+        self.archive.write([], spectrogram_store=self.store)
+
+        self.assertFalse("a" in self.archive)
+
+
+class PowerLevelTest(TestCase):
+    spectrogram = np.array([[0, 1e-20, 1e-15, 1e-3], [1, 2.5, 1e3, 0]], dtype=np.float32)
+    expected = librosa.power_to_db(spectrogram, ref=1.0, amin=1e-15, top_db=None)
+
+    def test_power_level(self):
+        np.testing.assert_allclose(self.expected, LabeledExample._power_level_from_power_spectrogram(self.spectrogram),
+                                   rtol=1e-5)
+
+    @skipIf(_jit_compiled_power_level is None, "numba is not installed")
+    def test_jit_compiled_power_level(self):
+        np.testing.assert_allclose(self.expected, _jit_compiled_power_level(self.spectrogram, -150.), rtol=1e-5)
+
+    @skipIf(_jit_compiled_power_level is None, "numba is not installed")
+    def test_jit_compiled_power_level_of_fortran_ordered(self):
+        fortran_ordered = np.asfortranarray(self.spectrogram)
+        np.testing.assert_allclose(self.expected, _jit_compiled_power_level(fortran_ordered, -150.), rtol=1e-5)
+        np.testing.assert_allclose(self.expected.T, _jit_compiled_power_level(self.spectrogram.T, -150.), rtol=1e-5)
@@ -1,6 +1,6 @@
 import logging
 import sys
-from itertools import groupby
+from itertools import islice
 from pathlib import Path
 from time import strftime
 
@@ -77,15 +77,35 @@ V = TypeVar('Value')
 
 
 def group(iterable: Iterable[E], key: Callable[[E], K], value: Callable[[E], V] = lambda x: x) -> Dict[K, Tuple[V]]:
-    return OrderedDict((k, tuple(map(value, values))) for k, values in groupby(sorted(iterable, key=key), key))
+    """
+    Keys are ordered by first occurrence (not sorted), values keep their order within each group.
+    """
+    values_by_key = OrderedDict()
+    for item in iterable:
+        values_by_key.setdefault(key(item), []).append(value(item))
+
+    return OrderedDict((k, tuple(values)) for k, values in values_by_key.items())
 
 
 def timestamp() -> str:
     return strftime("%Y%m%d-%H%M%S")
 
 
-def duplicates(sequence: Iterable[E]) -> List[E]:
-    return [item for item, count in Counter(sequence).items() if count > 1]
+def first_duplicates(iterable: Iterable[E], limit: int = 10) -> List[E]:
+    """
+    Single pass that stops as soon as limit duplicates are found.
+    """
+    seen = set()
+    found = []
+    for item in iterable:
+        if item in seen:
+            found.append(item)
+            if len(found) >= limit:
+                break
+        else:
+            seen.add(item)
+
+    return found
 
 
 def average_or_nan(numbers: List[float]) -> float:
@@ -95,9 +115,14 @@ def average_or_nan(numbers: List[float]) -> float:
     return sum(numbers) / len(numbers)
 
 
-def paginate(sequence: List[E], page_size: int) -> Iterable[List[E]]:
-    for start in range(0, len(sequence), page_size):
-        yield sequence[start:start + page_size]
+def paginate(iterable: Iterable[E], page_size: int) -> Iterable[List[E]]:
+    iterator = iter(iterable)
+    while True:
+        page = list(islice(iterator, page_size))
+        if not page:
+            return
+
+        yield page
 
 
 logger = getLogger("results")